@@ -5,24 +5,48 @@ Flask + PostgreSQL/SQLite によるWebアプリケーション
 Supabase対応版
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify,
+                   send_from_directory, Response)
 from werkzeug.utils import secure_filename
+from jinja2 import FileSystemBytecodeCache
+from flask_caching import Cache
+from flask_compress import Compress
+import orjson
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow がなければサムネイルを作らず元画像を表示
+    Image = None
 from datetime import datetime, date, timedelta
 import os
 import csv
 import io
+import time
+import threading
+import click
+from contextlib import contextmanager, nullcontext
+import atexit
+import functools
+import bisect
+import itertools
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 # PostgreSQL対応
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
 if DATABASE_URL:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    import psycopg2.pool
+    import psycopg2.extensions
+    from psycopg2.extras import RealDictCursor, execute_values
     USE_POSTGRES = True
+    DB_INTEGRITY_ERROR = psycopg2.IntegrityError
     print("📦 PostgreSQL (Supabase) モードで起動")
 else:
     import sqlite3
     USE_POSTGRES = False
+    DB_INTEGRITY_ERROR = sqlite3.IntegrityError
     DATABASE = 'merchandise.db'
     print("📦 SQLite モードで起動（ローカル開発用）")
 
@@ -34,20 +58,154 @@ UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# コンパイル済みテンプレートをディスクに残し、再起動や他ワーカーでは再コンパイルしない
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache()}
+PER_PAGE = 50  # 一覧の1ページあたりの件数（?per_page= で MAX_PER_PAGE まで変更可）
+MAX_PER_PAGE = 200
 
+# APIレスポンスの短時間キャッシュ（プロセス内）
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 30})
+API_MAX_AGE = 5  # ポーリングするクライアントに許すAPIレスポンスの再利用秒数
 
-def get_db():
+# HTML一覧・CSV出力などテキスト系のレスポンスを圧縮
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'text/javascript', 'application/json', 'text/csv']
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+
+
+# 接続プール（リクエストごとの接続・切断コストを回避）
+if USE_POSTGRES:
+    class PooledConnection(psycopg2.extensions.connection):
+        """プール接続（PREPARE済みの文を接続ごとに記録）"""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared = set()
+
+    _pg_pool = psycopg2.pool.ThreadedConnectionPool(minconn=2, maxconn=10, dsn=DATABASE_URL,
+                                                    connection_factory=PooledConnection)
+
+
+def _sqlite_connect():
+    """SQLite接続を作成（プールに入れて使い回す）"""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    # 接続ごとの設定（journal_mode=WAL はDBファイルに残るので init_db() で1回だけ設定）
+    conn.executescript("""
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-20000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA foreign_keys=ON;
+    """)
+    return conn
+
+
+if not USE_POSTGRES:
+    # スレッド数に関係なく接続数を上限で抑える（空きがなければ返却を待つ）
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+    _sqlite_pool = queue.Queue(maxsize=SQLITE_POOL_SIZE)
+    for _ in range(SQLITE_POOL_SIZE):
+        _sqlite_pool.put(_sqlite_connect())
+
+
+@contextmanager
+def db():
+    """プールから接続を借り、ブロックを抜けたら返却する"""
+    conn = _pg_pool.getconn() if USE_POSTGRES else _sqlite_pool.get()
+    try:
+        yield conn
+    finally:
+        if USE_POSTGRES:
+            if not conn.closed:
+                conn.rollback()
+            _pg_pool.putconn(conn, close=bool(conn.closed))
+        else:
+            conn.rollback()
+            _sqlite_pool.put(conn)
+
+
+# SQLiteの書き込みは1本ずつしか通らないため、プロセス内ではロックで順番待ちさせる
+# （ビジー待ちのリトライを避ける。PostgreSQLは行ロックに任せる）
+_write_lock = threading.Lock() if not USE_POSTGRES else nullcontext()
+
+
+@contextmanager
+def write_db():
+    """書き込み用の接続を借りる（SQLiteはプロセス内で書き込みを直列化）"""
+    try:
+        with _write_lock, db() as conn:
+            yield conn
+    finally:
+        # このプロセスの集計キャッシュは書き込みのたびに捨てる
+        cache.delete_many(STATS_CACHE_KEY, API_STATS_CACHE_KEY)
+
+
+def close_pool():
+    """終了時にプールの接続を閉じる"""
     if USE_POSTGRES:
-        return psycopg2.connect(DATABASE_URL)
-    else:
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
-        return conn
+        _pg_pool.closeall()
+        return
+    while True:
+        try:
+            _sqlite_pool.get_nowait().close()
+        except queue.Empty:
+            break
 
 
-def db_execute(conn, query, params=None):
+atexit.register(close_pool)
+
+
+# サーバー側で PREPARE する頻出クエリ（PG_PREPARED_STATEMENTS=1 で有効化）
+# Supabase のトランザクションモードのプーラー（pgbouncer 等）はトランザクションをまたいで
+# PREPARE した文を保持しないため、直接接続のときだけ有効にする
+# 主キーでの取得（PREPARE 対象は文字列の一致で判定するため、呼び出し側も同じ定数を使う）
+MERCHANDISE_BY_ID_SQL = 'SELECT * FROM merchandise WHERE id = %s'
+CUSTOMER_BY_ID_SQL = 'SELECT * FROM customers WHERE id = %s'
+PREPARED_STATEMENTS = {
+    MERCHANDISE_BY_ID_SQL: 'merchandise_by_id',
+    CUSTOMER_BY_ID_SQL: 'customer_by_id',
+}
+USE_PREPARED = os.environ.get('PG_PREPARED_STATEMENTS', '0') == '1'
+
+
+@functools.lru_cache(maxsize=256)
+def translate_sql(query):
+    """SQLite向けにプレースホルダを変換（変換結果はキャッシュ）"""
+    if USE_POSTGRES:
+        return query
+    return query.replace('%s', '?').replace("''", '""')
+
+
+def pg_execute(conn, cur, query, params):
+    """PostgreSQLでクエリを実行（頻出クエリは接続ごとにPREPAREして再利用）"""
+    name = PREPARED_STATEMENTS.get(query) if USE_PREPARED else None
+    if name is None:
+        cur.execute(query, params or ())
+        return
+    if name not in conn.prepared:
+        parts = query.split('%s')
+        numbered = parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+        cur.execute(f'PREPARE {name} AS {numbered}')
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+@contextmanager
+def tx(conn):
+    """ブロック内の書き込みを1トランザクションでコミット（例外時はロールバック）"""
     if not USE_POSTGRES:
-        query = query.replace('%s', '?').replace("''", '""')
+        # 書き込みロックを先に取り、読んでから書く途中での SQLITE_BUSY を避ける
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def db_execute(conn, query, params=None):
+    query = translate_sql(query)
     if USE_POSTGRES:
         cur = conn.cursor()
         cur.execute(query, params or ())
@@ -59,11 +217,10 @@ def db_execute(conn, query, params=None):
 
 
 def db_fetchone(conn, query, params=None):
-    if not USE_POSTGRES:
-        query = query.replace('%s', '?').replace("''", '""')
+    query = translate_sql(query)
     if USE_POSTGRES:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute(query, params or ())
+        pg_execute(conn, cur, query, params)
         result = cur.fetchone()
         cur.close()
         return dict(result) if result else None
@@ -74,11 +231,10 @@ def db_fetchone(conn, query, params=None):
 
 
 def db_fetchall(conn, query, params=None):
-    if not USE_POSTGRES:
-        query = query.replace('%s', '?').replace("''", '""')
+    query = translate_sql(query)
     if USE_POSTGRES:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute(query, params or ())
+        pg_execute(conn, cur, query, params)
         results = cur.fetchall()
         cur.close()
         return [dict(r) for r in results]
@@ -87,9 +243,34 @@ def db_fetchall(conn, query, params=None):
         return [dict(r) for r in cur.fetchall()]
 
 
+def db_fetchall_tuples(conn, query, params=None):
+    """列名の辞書を作らずに行をタプル（SQLiteは sqlite3.Row）のまま返す"""
+    query = translate_sql(query)
+    if USE_POSTGRES:
+        cur = conn.cursor()
+        pg_execute(conn, cur, query, params)
+        results = cur.fetchall()
+        cur.close()
+        return results
+    else:
+        return conn.execute(query, params or ()).fetchall()
+
+
+def db_fetchone_scalar(conn, query, params=None):
+    """1行目の先頭の列だけを返す"""
+    query = translate_sql(query)
+    if USE_POSTGRES:
+        cur = conn.cursor()
+        pg_execute(conn, cur, query, params)
+        result = cur.fetchone()
+        cur.close()
+    else:
+        result = conn.execute(query, params or ()).fetchone()
+    return result[0] if result else None
+
+
 def db_insert(conn, query, params=None):
-    if not USE_POSTGRES:
-        query = query.replace('%s', '?').replace("''", '""')
+    query = translate_sql(query)
     if USE_POSTGRES:
         if 'RETURNING' not in query.upper():
             query = query.rstrip().rstrip(')') + ') RETURNING id'
@@ -105,96 +286,426 @@ def db_insert(conn, query, params=None):
         return cur.lastrowid
 
 
-def init_db():
-    conn = get_db()
+_stream_cursor_ids = itertools.count(1)
+
+
+def db_iter(conn, query, params=None, batch=1000):
+    """結果を batch 件ずつ取り出してタプルのまま1行ずつ返す（PostgreSQLはサーバー側カーソル）"""
+    query = translate_sql(query)
     if USE_POSTGRES:
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS merchandise (
-                id SERIAL PRIMARY KEY,
-                purchase_date TEXT, photo_path TEXT, product_name TEXT NOT NULL,
-                store_name TEXT, purchase_price REAL DEFAULT 0, payment_method TEXT,
-                is_listed INTEGER DEFAULT 0, listing_date TEXT, sold_date TEXT,
-                listing_price REAL DEFAULT 0, expected_shipping REAL DEFAULT 0, expected_commission REAL DEFAULT 0,
-                sale_price REAL DEFAULT 0, shipping_cost REAL DEFAULT 0,
-                sales_platform TEXT, commission REAL DEFAULT 0, is_shipped INTEGER DEFAULT 0,
-                memo TEXT, customer_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # 既存テーブルにカラムがなければ追加
+        cur = conn.cursor(name=f'stream_cur_{next(_stream_cursor_ids)}')
+        cur.itersize = batch
+        cur.execute(query, params or ())
         try:
-            cur.execute('ALTER TABLE merchandise ADD COLUMN IF NOT EXISTS listing_price REAL DEFAULT 0')
-            cur.execute('ALTER TABLE merchandise ADD COLUMN IF NOT EXISTS expected_shipping REAL DEFAULT 0')
-            cur.execute('ALTER TABLE merchandise ADD COLUMN IF NOT EXISTS expected_commission REAL DEFAULT 0')
-            conn.commit()
-        except:
-            pass
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS customers (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL, email TEXT, phone TEXT, address TEXT, memo TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
+            yield from cur
+        finally:
+            cur.close()
+    else:
+        cur = conn.execute(query, params or ())
+        cur.arraysize = batch
+        try:
+            while True:
+                rows = cur.fetchmany()
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+
+
+def db_insert_many(conn, table, cols, rows, page_size=1000, commit=True):
+    """複数行をまとめてINSERT（PostgreSQLは execute_values、SQLiteは executemany）"""
+    rows = list(rows)
+    if not rows:
+        return 0
+    col_list = ', '.join(cols)
+    if USE_POSTGRES:
+        cur = conn.cursor()
+        execute_values(cur, f'INSERT INTO {table} ({col_list}) VALUES %s', rows, page_size=page_size)
         cur.close()
     else:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS merchandise (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                purchase_date TEXT, photo_path TEXT, product_name TEXT NOT NULL,
-                store_name TEXT, purchase_price REAL DEFAULT 0, payment_method TEXT,
-                is_listed INTEGER DEFAULT 0, listing_date TEXT, sold_date TEXT,
-                listing_price REAL DEFAULT 0, expected_shipping REAL DEFAULT 0, expected_commission REAL DEFAULT 0,
-                sale_price REAL DEFAULT 0, shipping_cost REAL DEFAULT 0,
-                sales_platform TEXT, commission REAL DEFAULT 0, is_shipped INTEGER DEFAULT 0,
-                memo TEXT, customer_id INTEGER,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS customers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL, email TEXT, phone TEXT, address TEXT, memo TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        placeholders = ', '.join(['?'] * len(cols))
+        conn.executemany(f'INSERT INTO {table} ({col_list}) VALUES ({placeholders})', rows)
+    if commit:
         conn.commit()
-    conn.close()
+    return len(rows)
+
+
+# 一覧の絞り込み・顧客集計で使う列のインデックス
+MERCHANDISE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_merch_purchase_date ON merchandise(purchase_date)',
+    # 「出品中」(is_listed = 1 かつ未売却) を1本で絞れる複合インデックス（旧 idx_merch_is_listed を置換）
+    'DROP INDEX IF EXISTS idx_merch_is_listed',
+    'CREATE INDEX IF NOT EXISTS idx_merch_listed_sold ON merchandise(is_listed, sold_date)',
+    # 顧客別の売上集計を表を読まずに済ませるカバリングインデックス（旧 idx_merch_customer_sold を置換）
+    'DROP INDEX IF EXISTS idx_merch_customer_sold',
+    'CREATE INDEX IF NOT EXISTS idx_merch_customer_sales ON merchandise(customer_id, sold_date, sale_price)',
+)
+
+
+# 検索対象の列（PostgreSQLは連結式にトライグラム、SQLiteはFTS5で索引化）
+PG_SEARCH_TEXT = "product_name || ' ' || COALESCE(store_name, '') || ' ' || COALESCE(sales_platform, '')"
+FTS_MIN_LENGTH = 3  # trigram トークナイザが扱える最短の検索語
+USE_FTS = False
+
+
+def init_sqlite_fts(conn):
+    """FTS5 (trigram) の検索用テーブルと同期トリガーを作成"""
+    global USE_FTS
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'merch_fts'").fetchone()
+    try:
+        conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS merch_fts USING fts5(
+                product_name, store_name, sales_platform,
+                content='merchandise', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS merch_fts_ai AFTER INSERT ON merchandise BEGIN
+                INSERT INTO merch_fts(rowid, product_name, store_name, sales_platform)
+                VALUES (new.id, new.product_name, new.store_name, new.sales_platform);
+            END;
+            CREATE TRIGGER IF NOT EXISTS merch_fts_ad AFTER DELETE ON merchandise BEGIN
+                INSERT INTO merch_fts(merch_fts, rowid, product_name, store_name, sales_platform)
+                VALUES ('delete', old.id, old.product_name, old.store_name, old.sales_platform);
+            END;
+            CREATE TRIGGER IF NOT EXISTS merch_fts_au AFTER UPDATE OF product_name, store_name, sales_platform
+            ON merchandise BEGIN
+                INSERT INTO merch_fts(merch_fts, rowid, product_name, store_name, sales_platform)
+                VALUES ('delete', old.id, old.product_name, old.store_name, old.sales_platform);
+                INSERT INTO merch_fts(rowid, product_name, store_name, sales_platform)
+                VALUES (new.id, new.product_name, new.store_name, new.sales_platform);
+            END;
+        """)
+        if not exists:
+            conn.execute("INSERT INTO merch_fts(merch_fts) VALUES ('rebuild')")
+            conn.commit()
+    except sqlite3.OperationalError:
+        # FTS5 / trigram 非対応のSQLiteでは LIKE 検索のまま
+        return
+    USE_FTS = True
+
+
+def merchandise_search_sql(search):
+    """商品名・店舗名・販売先の部分一致検索条件を返す"""
+    if USE_POSTGRES:
+        return f"({PG_SEARCH_TEXT}) ILIKE %s ESCAPE '!'", [like_pattern(search)]
+    if USE_FTS and len(search) >= FTS_MIN_LENGTH:
+        phrase = '"' + search.replace('"', '""') + '"'
+        return 'id IN (SELECT rowid FROM merch_fts WHERE merch_fts MATCH %s)', [phrase]
+    pattern = like_pattern(search)
+    return ("(product_name LIKE %s ESCAPE '!' OR store_name LIKE %s ESCAPE '!' "
+            "OR sales_platform LIKE %s ESCAPE '!')"), [pattern, pattern, pattern]
+
+
+SCHEMA_VERSION = 4  # init_db() のDDLを変更したら上げる
+
+SQLITE_MERCHANDISE_COLUMNS = '''
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    purchase_date TEXT, photo_path TEXT, product_name TEXT NOT NULL,
+    store_name TEXT, purchase_price REAL DEFAULT 0, payment_method TEXT,
+    is_listed INTEGER DEFAULT 0, listing_date TEXT, sold_date TEXT,
+    listing_price REAL DEFAULT 0, expected_shipping REAL DEFAULT 0, expected_commission REAL DEFAULT 0,
+    sale_price REAL DEFAULT 0, shipping_cost REAL DEFAULT 0,
+    sales_platform TEXT, commission REAL DEFAULT 0, is_shipped INTEGER DEFAULT 0,
+    memo TEXT, customer_id INTEGER REFERENCES customers(id) ON DELETE SET NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+'''
+
+
+def get_schema_version(conn):
+    """適用済みのスキーマバージョン（PostgreSQLはテーブルコメント、SQLiteは user_version）"""
+    if USE_POSTGRES:
+        version = db_fetchone_scalar(conn, "SELECT obj_description(to_regclass('merchandise'), 'pg_class')")
+        return int(version) if version and version.isdigit() else 0
+    return db_fetchone_scalar(conn, 'PRAGMA user_version')
+
+
+def migrate_sqlite_customer_fk(conn):
+    """外部キーのない旧 merchandise テーブルを ON DELETE SET NULL 付きで作り直す"""
+    if conn.execute('PRAGMA foreign_key_list(merchandise)').fetchone():
+        return
+    cols = [r['name'] for r in conn.execute('PRAGMA table_info(merchandise)')]
+    select = ', '.join('CASE WHEN customer_id IN (SELECT id FROM customers) THEN customer_id END'
+                       if col == 'customer_id' else col for col in cols)
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'merchandise'").fetchone()
+    # テーブルの作り直し中は外部キー検査を止める（トランザクション外でしか切り替えられない）
+    conn.commit()
+    conn.execute('PRAGMA foreign_keys=OFF')
+    try:
+        with tx(conn):
+            conn.execute(f'CREATE TABLE merchandise_new ({SQLITE_MERCHANDISE_COLUMNS})')
+            conn.execute(f'INSERT INTO merchandise_new ({", ".join(cols)}) SELECT {select} FROM merchandise')
+            conn.execute('DROP TABLE merchandise')
+            conn.execute('ALTER TABLE merchandise_new RENAME TO merchandise')
+            if seq:
+                conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'merchandise'", (seq[0],))
+    finally:
+        conn.execute('PRAGMA foreign_keys=ON')
+
+
+def init_db(force=False):
+    global USE_FTS
+    with db() as conn:
+        # 各ワーカーの起動ごとにDDLを流さないよう、最新なら確認のみで終了
+        if not force and get_schema_version(conn) >= SCHEMA_VERSION:
+            if not USE_POSTGRES:
+                USE_FTS = db_fetchone_scalar(conn, "SELECT 1 FROM sqlite_master WHERE name = 'merch_fts'") is not None
+            return
+        if USE_POSTGRES:
+            cur = conn.cursor()
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS merchandise (
+                    id SERIAL PRIMARY KEY,
+                    purchase_date TEXT, photo_path TEXT, product_name TEXT NOT NULL,
+                    store_name TEXT, purchase_price REAL DEFAULT 0, payment_method TEXT,
+                    is_listed INTEGER DEFAULT 0, listing_date TEXT, sold_date TEXT,
+                    listing_price REAL DEFAULT 0, expected_shipping REAL DEFAULT 0, expected_commission REAL DEFAULT 0,
+                    sale_price REAL DEFAULT 0, shipping_cost REAL DEFAULT 0,
+                    sales_platform TEXT, commission REAL DEFAULT 0, is_shipped INTEGER DEFAULT 0,
+                    memo TEXT, customer_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # 既存テーブルにカラムがなければ追加
+            try:
+                cur.execute('ALTER TABLE merchandise ADD COLUMN IF NOT EXISTS listing_price REAL DEFAULT 0')
+                cur.execute('ALTER TABLE merchandise ADD COLUMN IF NOT EXISTS expected_shipping REAL DEFAULT 0')
+                cur.execute('ALTER TABLE merchandise ADD COLUMN IF NOT EXISTS expected_commission REAL DEFAULT 0')
+                conn.commit()
+            except:
+                pass
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS customers (
+                    id SERIAL PRIMARY KEY,
+                    name TEXT NOT NULL, email TEXT, phone TEXT, address TEXT, memo TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # 顧客削除時にDB側で customer_id を NULL にする（存在しない顧客への参照は先に外す）
+            cur.execute('UPDATE merchandise SET customer_id = NULL WHERE customer_id IS NOT NULL '
+                        'AND customer_id NOT IN (SELECT id FROM customers)')
+            cur.execute('ALTER TABLE merchandise DROP CONSTRAINT IF EXISTS merchandise_customer_id_fkey')
+            cur.execute('ALTER TABLE merchandise ADD CONSTRAINT merchandise_customer_id_fkey '
+                        'FOREIGN KEY (customer_id) REFERENCES customers(id) ON DELETE SET NULL')
+            for index_sql in MERCHANDISE_INDEXES:
+                cur.execute(index_sql)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_merch_sold_date ON merchandise(sold_date) "
+                        "WHERE sold_date IS NOT NULL AND sold_date != ''")
+            conn.commit()
+            # 部分一致検索用のトライグラムインデックス（拡張が使えなければ通常検索）
+            try:
+                cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                cur.execute(f'CREATE INDEX IF NOT EXISTS idx_merch_trgm ON merchandise '
+                            f'USING gin (({PG_SEARCH_TEXT}) gin_trgm_ops)')
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+            # 新しいインデックスをプランナーに使わせるため統計を更新
+            cur.execute('ANALYZE merchandise')
+            cur.execute(f"COMMENT ON TABLE merchandise IS '{SCHEMA_VERSION}'")
+            conn.commit()
+            cur.close()
+        else:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS merchandise ({SQLITE_MERCHANDISE_COLUMNS})')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS customers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL, email TEXT, phone TEXT, address TEXT, memo TEXT,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            migrate_sqlite_customer_fk(conn)
+            for index_sql in MERCHANDISE_INDEXES:
+                conn.execute(index_sql)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_merch_sold_date ON merchandise(sold_date)')
+            conn.commit()
+            init_sqlite_fts(conn)
+            conn.execute('ANALYZE merchandise')
+            conn.commit()
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
 
 # ランク設定
 RANK_THRESHOLDS = {'platinum': 100000, 'gold': 50000, 'silver': 10000, 'bronze': 0}
 RANK_COLORS = {'platinum': '#E5E4E2', 'gold': '#FFD700', 'silver': '#C0C0C0', 'bronze': '#CD7F32'}
 RANK_NAMES = {'platinum': 'プラチナ', 'gold': 'ゴールド', 'silver': 'シルバー', 'bronze': 'ブロンズ'}
+RANK_ORDER = ('platinum', 'gold', 'silver', 'bronze')
+# bisect用: 昇順のランク名と、ブロンズより上のランクの下限額
+RANK_ASCENDING = RANK_ORDER[::-1]
+RANK_CUTOFFS = tuple(RANK_THRESHOLDS[r] for r in RANK_ASCENDING[1:])
+# ランクごとの表示用情報（RANK_ASCENDING と同じ並び）
+RANK_TABLE = tuple({'rank': r, 'rank_name': RANK_NAMES[r], 'rank_color': RANK_COLORS[r]} for r in RANK_ASCENDING)
 
 
-def get_customer_rank(total):
-    if total >= RANK_THRESHOLDS['platinum']: return 'platinum'
-    if total >= RANK_THRESHOLDS['gold']: return 'gold'
-    if total >= RANK_THRESHOLDS['silver']: return 'silver'
-    return 'bronze'
+def get_rank_info(total):
+    """購入総額からランク・表示名・色をまとめて取得"""
+    return RANK_TABLE[bisect.bisect_right(RANK_CUTOFFS, total)]
 
 
-def get_customer_stats(conn, customer_id):
-    result = db_fetchone(conn, '''
-        SELECT COUNT(*) as purchase_count, COALESCE(SUM(sale_price), 0) as total_purchase
+def get_customer_purchases(conn, customer_id):
+    """購入履歴と購入集計を1回のクエリで取得（集計はウィンドウ関数で各行に付ける）"""
+    purchases = db_fetchall(conn, '''
+        SELECT sold_date, product_name, sale_price,
+            COUNT(*) OVER () AS purchase_count, COALESCE(SUM(sale_price) OVER (), 0) AS total_purchase
         FROM merchandise WHERE customer_id = %s AND sold_date IS NOT NULL AND sold_date != ''
+        ORDER BY sold_date DESC
     ''', (customer_id,))
-    total = (result['total_purchase'] if result else 0) or 0
-    count = (result['purchase_count'] if result else 0) or 0
-    rank = get_customer_rank(total)
-    return {'purchase_count': count, 'total_purchase': total, 'rank': rank,
-            'rank_name': RANK_NAMES[rank], 'rank_color': RANK_COLORS[rank]}
+    count, total = (purchases[0]['purchase_count'], purchases[0]['total_purchase']) if purchases else (0, 0)
+    return purchases, {'purchase_count': count, 'total_purchase': total, **get_rank_info(total)}
+
+
+class CustomerRow:
+    """顧客一覧の1行（購入集計・ランク付き）。行ごとの辞書を作らない"""
+    __slots__ = ('id', 'name', 'email', 'phone', 'purchase_count', 'total_purchase',
+                 'rank', 'rank_name', 'rank_color')
+
+    def __init__(self, id, name, email, phone, purchase_count, total_purchase):
+        self.id, self.name, self.email, self.phone = id, name, email, phone
+        self.purchase_count, self.total_purchase = purchase_count, total_purchase
+        info = get_rank_info(total_purchase)
+        self.rank, self.rank_name, self.rank_color = info['rank'], info['rank_name'], info['rank_color']
+
+
+def get_page_args():
+    """ページ番号・キーセット用の after_id・1ページの件数をクエリ文字列から取得"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    after_id = request.args.get('after_id', type=int)
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    return page, after_id, per_page
+
+
+def page_sql(page, after_id, per_page):
+    """LIMIT/OFFSET 句（次ページ判定のため1件多く取得、after_id 指定時はOFFSET不要）"""
+    if after_id or page == 1:
+        return ' LIMIT %s', [per_page + 1]
+    return ' LIMIT %s OFFSET %s', [per_page + 1, (page - 1) * per_page]
+
+
+def like_pattern(term):
+    """部分一致検索用のLIKEパターン（ESCAPE '!' と併用）"""
+    escaped = term.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+    return f'%{escaped}%'
+
+
+def customer_filter_sql(search, rank_filter, after_id=None):
+    """顧客一覧の検索・ランク・ページ条件を WHERE / HAVING 句に変換"""
+    conditions, having, params = [], '', []
+    if search:
+        conditions.append("LOWER(c.name) LIKE %s ESCAPE '!'")
+        params.append(like_pattern(search.lower()))
+    if after_id:
+        conditions.append('c.id < %s')
+        params.append(after_id)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    if rank_filter != 'all':
+        if rank_filter not in RANK_ORDER:
+            return where, ' HAVING 1 = 0', params
+        total = 'COALESCE(SUM(m.sale_price), 0)'
+        i = RANK_ORDER.index(rank_filter)
+        bounds = []
+        if i + 1 < len(RANK_ORDER):
+            bounds.append(f'{total} >= %s')
+            params.append(RANK_THRESHOLDS[rank_filter])
+        if i > 0:
+            bounds.append(f'{total} < %s')
+            params.append(RANK_THRESHOLDS[RANK_ORDER[i - 1]])
+        if bounds:
+            having = ' HAVING ' + ' AND '.join(bounds)
+    return where, having, params
+
+
+STATS_CACHE_KEY = 'merchandise_stats'
+API_STATS_CACHE_KEY = 'api_stats'  # /api/stats のETagとJSON本文
+STATS_CACHE_TTL = 5  # 他のワーカーでの書き込みが反映されるまでの最大秒数
+
+
+def get_merchandise_stats(conn):
+    """商品の集計を1回のクエリで取得（短時間キャッシュし、write_db() で破棄）"""
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        stats = query_merchandise_stats(conn)
+        cache.set(STATS_CACHE_KEY, stats, timeout=STATS_CACHE_TTL)
+    return stats
+
+
+def query_merchandise_stats(conn):
+    return db_fetchone(conn, """
+        SELECT COUNT(*) AS total,
+            COALESCE(SUM(CASE WHEN is_listed = 1 THEN 1 ELSE 0 END), 0) AS listed,
+            COALESCE(SUM(CASE WHEN sold_date IS NOT NULL AND sold_date != '' THEN 1 ELSE 0 END), 0) AS sold,
+            COALESCE(SUM(CASE WHEN sold_date IS NOT NULL AND sold_date != ''
+                THEN sale_price - purchase_price - shipping_cost - commission ELSE 0 END), 0) AS total_profit,
+            COALESCE(SUM(purchase_price), 0) AS total_purchase,
+            COALESCE(SUM(CASE WHEN sold_date IS NOT NULL AND sold_date != '' THEN sale_price ELSE 0 END), 0) AS total_sales
+        FROM merchandise
+    """)
 
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return os.path.splitext(filename)[1][1:].lower() in ALLOWED_EXTENSIONS
+
+
+# 画像のディスク書き込みはリクエストスレッドから切り離して実行
+upload_executor = ThreadPoolExecutor(max_workers=4)
+
+
+THUMB_SIZE = (400, 400)
+THUMB_SUFFIX = '.thumb.webp'  # 一覧表示用の縮小画像（元画像のパスに付ける）
+app.jinja_env.globals['THUMB_SUFFIX'] = THUMB_SUFFIX if Image else ''
+
+
+def write_upload(filepath, data):
+    with open(filepath, 'wb') as f:
+        f.write(data)
+    if Image:
+        try:
+            with Image.open(filepath) as img:
+                # スマホ写真はEXIFの向き情報で回転させてから縮小する（WebPには向き情報を残さない）
+                thumb = ImageOps.exif_transpose(img)
+                thumb.thumbnail(THUMB_SIZE)
+                thumb.save(filepath + THUMB_SUFFIX, 'WEBP', quality=80)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            app.logger.warning('サムネイルを作成できませんでした: %s', e)
+
+
+def log_upload_error(future):
+    if future.exception():
+        app.logger.error('画像の保存に失敗しました: %s', future.exception())
+
+
+def save_photo(file):
+    """アップロード画像の保存先パスを返す（書き込みはバックグラウンド）"""
+    if not (file and file.filename and allowed_file(file.filename)):
+        return None
+    # ミリ秒単位の接頭辞で、同じ秒に届いた画像の上書きを防ぐ
+    filename = secure_filename(f"{time.time_ns() // 1_000_000:013d}_{file.filename}")
+    filepath = f"{app.config['UPLOAD_FOLDER']}/{filename}"
+    # リクエスト終了後はアップロードのストリームが閉じられるため、先に読み込んでから渡す
+    upload_executor.submit(write_upload, filepath, file.read()).add_done_callback(log_upload_error)
+    return filepath
+
+
+def existing_photo(value):
+    """フォームの hidden で戻ってきた既存写真のパス（アップロード先直下の安全な名前だけ受け付ける）"""
+    folder, _, name = (value or '').rpartition('/')
+    if folder == app.config['UPLOAD_FOLDER'] and name and secure_filename(name) == name:
+        return value
+    return None
+
+
+UPLOAD_MAX_AGE = 365 * 24 * 60 * 60  # アップロード画像は名前が一意で中身が変わらない
+
+
+@app.route('/static/uploads/<path:filename>')
+def uploaded_file(filename):
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=UPLOAD_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 def calculate_profit(item):
@@ -207,6 +718,17 @@ def calculate_profit_rate(item):
     return (profit / purchase * 100) if purchase > 0 else 0
 
 
+# 利益・利益率のSQL式（calculate_profit / calculate_profit_rate と同じ計算。画面・CSVはこちらを使い、
+# Python側の関数は互換のために残している）
+# PostgreSQLの REAL は単精度なので、倍精度に広げてから計算する
+_AS_DOUBLE = '::double precision' if USE_POSTGRES else ''
+PROFIT_SQL = '(' + ' - '.join(f'COALESCE({col}, 0){_AS_DOUBLE}' for col in
+                              ('sale_price', 'purchase_price', 'shipping_cost', 'commission')) + ')'
+PROFIT_RATE_SQL = f'CASE WHEN COALESCE(purchase_price, 0) > 0 THEN {PROFIT_SQL} / purchase_price * 100 ELSE 0 END'
+ITEM_VIEW_SQL = f'SELECT *, {PROFIT_SQL} AS profit, {PROFIT_RATE_SQL} AS profit_rate FROM merchandise WHERE id = %s'
+PREPARED_STATEMENTS[ITEM_VIEW_SQL] = 'merchandise_view_by_id'
+
+
 def calculate_expected_profit(item):
     """想定利益を計算（出品価格ベース）"""
     listing_price = item.get('listing_price') or 0
@@ -223,145 +745,185 @@ def calculate_expected_profit_rate(item):
     return (profit / purchase * 100) if purchase > 0 else 0
 
 
+@app.cli.command('init-db')
+@click.option('--force', is_flag=True, help='スキーマが最新でもDDLを流し直す')
+def init_db_command(force):
+    """データベースのテーブル・インデックスを作成・更新する"""
+    init_db(force=force)
+    click.echo(f'スキーマ バージョン {SCHEMA_VERSION} を適用しました')
+
+
 with app.app_context():
     init_db()
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    # 起動時に全テンプレートをコンパイルしてキャッシュしておく
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+
+
+# 一覧の絞り込み: filter_type -> (SQL条件, 今日の日付からパラメータを作る関数)
+FILTER_SQL = {
+    'today': ('purchase_date = %s', lambda today: (today.isoformat(),)),
+    'yesterday': ('purchase_date = %s', lambda today: ((today - timedelta(days=1)).isoformat(),)),
+    'this_week': ('purchase_date >= %s', lambda today: ((today - timedelta(days=today.weekday())).isoformat(),)),
+    'this_month': ('purchase_date >= %s', lambda today: (today.replace(day=1).isoformat(),)),
+    'not_listed': ('is_listed = 0', lambda today: ()),
+    'listed': ("is_listed = 1 AND (sold_date IS NULL OR sold_date = '')", lambda today: ()),
+    'sold': ("sold_date IS NOT NULL AND sold_date != ''", lambda today: ()),
+}
+
+
+@functools.lru_cache(maxsize=128)
+def index_query(filter_clause, search_clause, keyset, limit):
+    """一覧のSQL文（組み合わせは有限なので同じ文字列を使い回し、文のキャッシュに当てる）"""
+    conditions = [c for c in (search_clause, filter_clause, 'id < %s' if keyset else None) if c]
+    query = f'SELECT *, {PROFIT_SQL} AS profit, {PROFIT_RATE_SQL} AS profit_rate FROM merchandise'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    return query + ' ORDER BY id DESC' + limit
+
+
+@functools.lru_cache(maxsize=64)
+def index_count_query(filter_clause, search_clause):
+    """絞り込み条件に合う件数（ページ数の表示用）"""
+    conditions = [c for c in (search_clause, filter_clause) if c]
+    return 'SELECT COUNT(*) FROM merchandise WHERE ' + ' AND '.join(conditions)
 
 
 @app.route('/')
 def index():
-    conn = get_db()
     filter_type = request.args.get('filter', 'all')
     search = request.args.get('search', '')
+    page, after_id, per_page = get_page_args()
     
-    query = 'SELECT * FROM merchandise'
-    params = []
-    conditions = []
-    
-    if search:
-        conditions.append("(product_name LIKE %s OR store_name LIKE %s OR sales_platform LIKE %s)")
-        params.extend([f'%{search}%', f'%{search}%', f'%{search}%'])
-    
-    today = date.today()
-    if filter_type == 'today':
-        conditions.append('purchase_date = %s')
-        params.append(today.strftime('%Y-%m-%d'))
-    elif filter_type == 'yesterday':
-        conditions.append('purchase_date = %s')
-        params.append((today - timedelta(days=1)).strftime('%Y-%m-%d'))
-    elif filter_type == 'this_week':
-        conditions.append('purchase_date >= %s')
-        params.append((today - timedelta(days=today.weekday())).strftime('%Y-%m-%d'))
-    elif filter_type == 'this_month':
-        conditions.append('purchase_date >= %s')
-        params.append(today.replace(day=1).strftime('%Y-%m-%d'))
-    elif filter_type == 'not_listed':
-        conditions.append('is_listed = 0')
-    elif filter_type == 'listed':
-        conditions.append("is_listed = 1 AND (sold_date IS NULL OR sold_date = '')")
-    elif filter_type == 'sold':
-        conditions.append("sold_date IS NOT NULL AND sold_date != ''")
-    
-    if conditions:
-        query += ' WHERE ' + ' AND '.join(conditions)
-    query += ' ORDER BY id DESC'
-    
-    items = db_fetchall(conn, query, tuple(params) if params else None)
+    search_clause, params = merchandise_search_sql(search) if search else (None, [])
+    filter_clause, filter_params = FILTER_SQL.get(filter_type, (None, None))
+    if filter_clause:
+        params += filter_params(date.today())
+    count_params = tuple(params)
+    if after_id:
+        params.append(after_id)
+    limit, limit_params = page_sql(page, after_id, per_page)
+    query = index_query(filter_clause, search_clause, bool(after_id), limit)
     
-    stats = {
-        'total': db_fetchone(conn, 'SELECT COUNT(*) as cnt FROM merchandise')['cnt'],
-        'listed': db_fetchone(conn, 'SELECT COUNT(*) as cnt FROM merchandise WHERE is_listed = 1')['cnt'],
-        'sold': db_fetchone(conn, "SELECT COUNT(*) as cnt FROM merchandise WHERE sold_date IS NOT NULL AND sold_date != ''")['cnt'],
-        'total_profit': db_fetchone(conn, "SELECT COALESCE(SUM(sale_price - purchase_price - shipping_cost - commission), 0) as profit FROM merchandise WHERE sold_date IS NOT NULL AND sold_date != ''")['profit']
-    }
-    conn.close()
+    with db() as conn:
+        items = db_fetchall(conn, query, tuple(params + limit_params))
+        stats = get_merchandise_stats(conn)
+        # 絞り込みなしの件数は集計済みの total をそのまま使う
+        if filter_clause or search_clause:
+            total = db_fetchone_scalar(conn, index_count_query(filter_clause, search_clause), count_params)
+        else:
+            total = stats['total']
+    has_next = len(items) > per_page
+    items = items[:per_page]
     
     return render_template('index.html', items=items, stats=stats, filter_type=filter_type,
-                          search=search, calculate_profit=calculate_profit, calculate_profit_rate=calculate_profit_rate,
-                          calculate_expected_profit=calculate_expected_profit, calculate_expected_profit_rate=calculate_expected_profit_rate)
+                          search=search, page=page, has_next=has_next, per_page=per_page,
+                          total=total, pages=max(-(-total // per_page), 1))
+
+
+# 商品フォームの列（INSERT/UPDATE と item_params() の並び）
+ITEM_COLUMNS = ('purchase_date', 'photo_path', 'product_name', 'store_name',
+                'purchase_price', 'payment_method', 'is_listed', 'listing_date', 'sold_date',
+                'listing_price', 'expected_shipping', 'expected_commission',
+                'sale_price', 'shipping_cost', 'sales_platform', 'commission', 'is_shipped', 'memo', 'customer_id')
+ITEM_INSERT_SQL = (f"INSERT INTO merchandise ({', '.join(ITEM_COLUMNS)}) "
+                   f"VALUES ({', '.join(['%s'] * len(ITEM_COLUMNS))})")
+ITEM_UPDATE_SQL = (f"UPDATE merchandise SET {', '.join(f'{col}=%s' for col in ITEM_COLUMNS)}, "
+                   f"updated_at=CURRENT_TIMESTAMP WHERE id=%s")
+
+
+def form_float(data, key):
+    """数値項目（空欄・未送信は0）"""
+    value = data.get(key)
+    return float(value) if value else 0.0
+
+
+def form_str(data, key):
+    """任意の文字列項目（空欄・未送信はNone）"""
+    return data.get(key) or None
+
+
+def item_params(data, photo_path):
+    """フォーム（またはJSONの辞書）から ITEM_COLUMNS 順のパラメータを作る"""
+    get = data.get
+    # JSONの配列や辞書はDBドライバーが受け付けないので、ここで弾く（bool は int の派生）
+    for col in ITEM_COLUMNS:
+        value = get(col)
+        if value is not None and not isinstance(value, (str, int, float)):
+            raise TypeError(f'{col} には文字列か数値を指定してください')
+    customer_id = get('customer_id')
+    return (
+        form_str(data, 'purchase_date'), photo_path,
+        get('product_name'), form_str(data, 'store_name'),
+        form_float(data, 'purchase_price'), form_str(data, 'payment_method'),
+        1 if get('is_listed') else 0, form_str(data, 'listing_date'),
+        form_str(data, 'sold_date'),
+        form_float(data, 'listing_price'),
+        form_float(data, 'expected_shipping'),
+        form_float(data, 'expected_commission'),
+        form_float(data, 'sale_price'),
+        form_float(data, 'shipping_cost'), form_str(data, 'sales_platform'),
+        form_float(data, 'commission'), 1 if get('is_shipped') else 0,
+        form_str(data, 'memo'),
+        int(customer_id) if customer_id else None,
+    )
 
 
 @app.route('/add', methods=['GET', 'POST'])
 def add_item():
     if request.method == 'POST':
-        photo_path = None
-        if 'photo' in request.files:
-            file = request.files['photo']
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                photo_path = filepath
+        photo_path = save_photo(request.files.get('photo'))
+        params = item_params(request.form, photo_path)
         
-        conn = get_db()
-        db_insert(conn, '''
-            INSERT INTO merchandise (purchase_date, photo_path, product_name, store_name,
-                purchase_price, payment_method, is_listed, listing_date, sold_date,
-                listing_price, expected_shipping, expected_commission,
-                sale_price, shipping_cost, sales_platform, commission, is_shipped, memo, customer_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (
-            request.form.get('purchase_date') or None, photo_path,
-            request.form.get('product_name'), request.form.get('store_name') or None,
-            float(request.form.get('purchase_price') or 0), request.form.get('payment_method') or None,
-            1 if request.form.get('is_listed') else 0, request.form.get('listing_date') or None,
-            request.form.get('sold_date') or None,
-            float(request.form.get('listing_price') or 0),
-            float(request.form.get('expected_shipping') or 0),
-            float(request.form.get('expected_commission') or 0),
-            float(request.form.get('sale_price') or 0),
-            float(request.form.get('shipping_cost') or 0), request.form.get('sales_platform') or None,
-            float(request.form.get('commission') or 0), 1 if request.form.get('is_shipped') else 0,
-            request.form.get('memo') or None,
-            int(request.form.get('customer_id')) if request.form.get('customer_id') else None
-        ))
-        conn.close()
+        try:
+            with write_db() as conn:
+                item_id = db_insert(conn, ITEM_INSERT_SQL, params)
+        except DB_INTEGRITY_ERROR:
+            # 顧客の選択肢はキャッシュされるため、削除済みの顧客が送られてくることがある
+            flash('選択された顧客が見つかりません', 'error')
+            return redirect(url_for('add_item'))
         flash('商品を登録しました', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('view_item', id=item_id))
     
     return render_template('form.html', item=None, action='add')
 
 
+@app.route('/api/bulk_add', methods=['POST'])
+def api_bulk_add():
+    """JSON配列の商品をまとめて登録（1トランザクション・1回のコミット）"""
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not all(isinstance(item, dict) and item.get('product_name') for item in items):
+        return jsonify({'error': '商品名を含む商品の配列を送信してください'}), 400
+    try:
+        rows = [item_params(item, None) for item in items]
+    except (TypeError, ValueError):
+        return jsonify({'error': '金額・顧客IDは数値、その他の項目は文字列で指定してください'}), 400
+    try:
+        with write_db() as conn, tx(conn):
+            inserted = db_insert_many(conn, 'merchandise', ITEM_COLUMNS, rows, commit=False)
+    except DB_INTEGRITY_ERROR:
+        return jsonify({'error': '存在しない顧客IDが含まれています'}), 400
+    return jsonify({'inserted': inserted}), 201
+
+
 @app.route('/edit/<int:id>', methods=['GET', 'POST'])
 def edit_item(id):
-    conn = get_db()
     if request.method == 'POST':
-        photo_path = request.form.get('existing_photo')
-        if 'photo' in request.files:
-            file = request.files['photo']
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                photo_path = filepath
+        photo_path = save_photo(request.files.get('photo')) or existing_photo(request.form.get('existing_photo'))
+        params = item_params(request.form, photo_path) + (id,)
         
-        db_execute(conn, '''
-            UPDATE merchandise SET purchase_date=%s, photo_path=%s, product_name=%s, store_name=%s,
-                purchase_price=%s, payment_method=%s, is_listed=%s, listing_date=%s, sold_date=%s,
-                listing_price=%s, expected_shipping=%s, expected_commission=%s,
-                sale_price=%s, shipping_cost=%s, sales_platform=%s, commission=%s, is_shipped=%s,
-                memo=%s, customer_id=%s, updated_at=CURRENT_TIMESTAMP WHERE id=%s
-        ''', (
-            request.form.get('purchase_date') or None, photo_path,
-            request.form.get('product_name'), request.form.get('store_name') or None,
-            float(request.form.get('purchase_price') or 0), request.form.get('payment_method') or None,
-            1 if request.form.get('is_listed') else 0, request.form.get('listing_date') or None,
-            request.form.get('sold_date') or None,
-            float(request.form.get('listing_price') or 0),
-            float(request.form.get('expected_shipping') or 0),
-            float(request.form.get('expected_commission') or 0),
-            float(request.form.get('sale_price') or 0),
-            float(request.form.get('shipping_cost') or 0), request.form.get('sales_platform') or None,
-            float(request.form.get('commission') or 0), 1 if request.form.get('is_shipped') else 0,
-            request.form.get('memo') or None,
-            int(request.form.get('customer_id')) if request.form.get('customer_id') else None, id
-        ))
-        conn.close()
+        try:
+            with write_db() as conn:
+                db_execute(conn, ITEM_UPDATE_SQL, params)
+        except DB_INTEGRITY_ERROR:
+            flash('選択された顧客が見つかりません', 'error')
+            return redirect(url_for('edit_item', id=id))
         flash('商品を更新しました', 'success')
         return redirect(url_for('index'))
     
-    item = db_fetchone(conn, 'SELECT * FROM merchandise WHERE id = %s', (id,))
-    conn.close()
+    with db() as conn:
+        item = db_fetchone(conn, MERCHANDISE_BY_ID_SQL, (id,))
     if not item:
         flash('商品が見つかりません', 'error')
         return redirect(url_for('index'))
@@ -370,100 +932,231 @@ def edit_item(id):
 
 @app.route('/delete/<int:id>', methods=['POST'])
 def delete_item(id):
-    conn = get_db()
-    db_execute(conn, 'DELETE FROM merchandise WHERE id = %s', (id,))
-    conn.close()
+    with write_db() as conn:
+        db_execute(conn, 'DELETE FROM merchandise WHERE id = %s', (id,))
     flash('商品を削除しました', 'success')
     return redirect(url_for('index'))
 
 
 @app.route('/view/<int:id>')
 def view_item(id):
-    conn = get_db()
-    item = db_fetchone(conn, 'SELECT * FROM merchandise WHERE id = %s', (id,))
-    conn.close()
+    with db() as conn:
+        item = db_fetchone(conn, ITEM_VIEW_SQL, (id,))
     if not item:
         flash('商品が見つかりません', 'error')
         return redirect(url_for('index'))
-    return render_template('view.html', item=item, calculate_profit=calculate_profit, calculate_profit_rate=calculate_profit_rate)
+    return render_template('view.html', item=item)
+
+
+CSV_HEADERS = ['管理No', '仕入日', '商品名', '店舗名', '仕入額', '出品済', '出品日', '売却日',
+               '売上金', '送料', '販売先', '手数料', '利益', '利益率', '発送済', 'メモ']
+CSV_BATCH_SIZE = 1000
+
+# 列の並びは CSV_HEADERS と同じ。利益・利益率は画面と同じく Python の書式で丸める
+# （SQLの printf / ROUND は0.5を切り上げるため、画面の表示と1円ずれる）
+EXPORT_SQL = f"""
+    SELECT id, purchase_date, product_name, store_name, purchase_price,
+        CASE WHEN COALESCE(is_listed, 0) <> 0 THEN '✓' ELSE '' END,
+        listing_date, sold_date, sale_price, shipping_cost, sales_platform, commission,
+        {PROFIT_SQL}, {PROFIT_RATE_SQL},
+        CASE WHEN COALESCE(is_shipped, 0) <> 0 THEN '✓' ELSE '' END,
+        memo
+    FROM merchandise ORDER BY id DESC
+"""
+
+
+def attachment_headers(filename):
+    """日本語ファイル名に対応したダウンロード用ヘッダー"""
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii')
+    return {'Content-Disposition': f"attachment; filename={ascii_name}; filename*=UTF-8''{quote(filename)}"}
+
+
+def csv_line(row):
+    buf = io.StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue()
+
+
+# BOM付きの見出し行は毎回同じなので、エンコード済みのバイト列を使い回す
+CSV_HEADER_BYTES = ('\ufeff' + csv_line(CSV_HEADERS)).encode('utf-8')
+
+
+def export_rows(conn):
+    """db_iter の行を CSV_BATCH_SIZE 件ずつ writerows でCSVに変換して返す"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    items = db_iter(conn, EXPORT_SQL, batch=CSV_BATCH_SIZE)
+    for batch in iter(lambda: list(itertools.islice(items, CSV_BATCH_SIZE)), []):
+        writer.writerows([(*row[:12], f'{row[12]:.0f}', f'{row[13]:.1f}%', *row[14:]) for row in batch])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
 
 
 @app.route('/export')
 def export_csv():
-    conn = get_db()
-    items = db_fetchall(conn, 'SELECT * FROM merchandise ORDER BY id DESC')
-    conn.close()
+    def generate():
+        yield CSV_HEADER_BYTES
+        # ストリーミングが終わるまで接続を借りたままにする
+        with db() as conn:
+            yield from export_rows(conn)
     
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['管理No', '仕入日', '商品名', '店舗名', '仕入額', '出品済', '出品日', '売却日',
-                     '売上金', '送料', '販売先', '手数料', '利益', '利益率', '発送済', 'メモ'])
-    for item in items:
-        profit = calculate_profit(item)
-        writer.writerow([item['id'], item['purchase_date'] or '', item['product_name'],
-            item['store_name'] or '', item['purchase_price'], '✓' if item['is_listed'] else '',
-            item['listing_date'] or '', item['sold_date'] or '', item['sale_price'],
-            item['shipping_cost'], item['sales_platform'] or '', item['commission'],
-            f'{profit:.0f}', f'{calculate_profit_rate(item):.1f}%', '✓' if item['is_shipped'] else '',
-            item['memo'] or ''])
-    output.seek(0)
-    return send_file(io.BytesIO(output.getvalue().encode('utf-8-sig')), mimetype='text/csv',
-                     as_attachment=True, download_name=f'売上データ_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv')
+    filename = f'売上データ_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+    return Response(generate(), mimetype='text/csv', headers=attachment_headers(filename))
+
+
+# CSV取込（CSV出力と同じ列名を受け付ける。管理No・利益・利益率は無視）
+CSV_IMPORT_COLUMNS = {
+    '仕入日': 'purchase_date', '商品名': 'product_name', '店舗名': 'store_name', '仕入額': 'purchase_price',
+    '出品済': 'is_listed', '出品日': 'listing_date', '売却日': 'sold_date', '売上金': 'sale_price',
+    '送料': 'shipping_cost', '販売先': 'sales_platform', '手数料': 'commission', '発送済': 'is_shipped',
+    'メモ': 'memo',
+}
+CSV_IMPORT_NUMBERS = {'purchase_price', 'sale_price', 'shipping_cost', 'commission'}
+CSV_IMPORT_FLAGS = {'is_listed', 'is_shipped'}
+CSV_IMPORT_BATCH = 10000
+
+
+def csv_import_value(col, value):
+    value = (value or '').strip()
+    if col in CSV_IMPORT_NUMBERS:
+        return float(value.replace(',', '').replace('¥', '') or 0)
+    if col in CSV_IMPORT_FLAGS:
+        return 1 if value and value not in ('0', '✗', '×') else 0
+    return value or None
+
+
+@app.route('/import', methods=['POST'])
+def import_csv():
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('CSVファイルを選択してください', 'error')
+        return redirect(url_for('index'))
+    data = file.read()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp932', 'replace')  # Excel保存のShift_JIS
+    reader = csv.DictReader(io.StringIO(text))
+    cols = [col for header, col in CSV_IMPORT_COLUMNS.items() if header in (reader.fieldnames or [])]
+    if 'product_name' not in cols:
+        flash('CSVに「商品名」列がありません', 'error')
+        return redirect(url_for('index'))
+    
+    headers = {col: header for header, col in CSV_IMPORT_COLUMNS.items()}
+    name_index = cols.index('product_name')
+    imported, skipped, batch = 0, 0, []
+    with write_db() as conn:
+        # 取込全体を1トランザクションにまとめ、コミット（fsync）は最後の1回だけ
+        with tx(conn):
+            for record in reader:
+                try:
+                    row = tuple(csv_import_value(col, record.get(headers[col])) for col in cols)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if not row[name_index]:
+                    skipped += 1
+                    continue
+                batch.append(row)
+                if len(batch) >= CSV_IMPORT_BATCH:
+                    imported += db_insert_many(conn, 'merchandise', cols, batch, commit=False)
+                    batch = []
+            imported += db_insert_many(conn, 'merchandise', cols, batch, commit=False)
+    
+    message = f'{imported}件の商品を取り込みました'
+    if skipped:
+        message += f'（{skipped}件はスキップ）'
+    flash(message, 'success')
+    return redirect(url_for('index'))
+
+
+def json_bytes(obj):
+    """JSON本文を orjson でエンコード（キー順は Flask の jsonify と同じく昇順）"""
+    return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
 
 
 @app.route('/api/stats')
 def api_stats():
-    conn = get_db()
-    stats = {
-        'total': db_fetchone(conn, 'SELECT COUNT(*) as cnt FROM merchandise')['cnt'],
-        'listed': db_fetchone(conn, 'SELECT COUNT(*) as cnt FROM merchandise WHERE is_listed = 1')['cnt'],
-        'sold': db_fetchone(conn, "SELECT COUNT(*) as cnt FROM merchandise WHERE sold_date IS NOT NULL AND sold_date != ''")['cnt'],
-        'total_profit': db_fetchone(conn, "SELECT COALESCE(SUM(sale_price - purchase_price - shipping_cost - commission), 0) as profit FROM merchandise WHERE sold_date IS NOT NULL AND sold_date != ''")['profit']
-    }
-    conn.close()
-    return jsonify(stats)
+    # ETagとエンコード済みの本文を集計キャッシュと同じ期間だけ使い回す
+    cached = cache.get(API_STATS_CACHE_KEY)
+    if cached is None:
+        with db() as conn:
+            stats = dict(get_merchandise_stats(conn))
+        etag = 'stats-' + '-'.join(str(stats[k]) for k in sorted(stats))
+        cached = (etag, json_bytes(stats))
+        cache.set(API_STATS_CACHE_KEY, cached, timeout=STATS_CACHE_TTL)
+    etag, body = cached
+    # 集計値が前回と同じなら本文なしの304を返す
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.max_age = API_MAX_AGE
+    return response
 
 
 # 顧客管理
 @app.route('/customers')
 def customers_list():
-    conn = get_db()
     rank_filter = request.args.get('rank', 'all')
     search = request.args.get('search', '')
     
-    customers = db_fetchall(conn, 'SELECT * FROM customers ORDER BY id DESC')
-    customers_with_stats = []
-    for c in customers:
-        stats = get_customer_stats(conn, c['id'])
-        c_dict = dict(c)
-        c_dict.update(stats)
-        if rank_filter != 'all' and stats['rank'] != rank_filter:
-            continue
-        if search and search.lower() not in c['name'].lower():
-            continue
-        customers_with_stats.append(c_dict)
+    page, after_id, per_page = get_page_args()
+    join = """
+        FROM customers c
+        LEFT JOIN merchandise m ON m.customer_id = c.id AND m.sold_date IS NOT NULL AND m.sold_date != ''
+    """
+    where, having, params = customer_filter_sql(search, rank_filter, after_id)
+    limit, limit_params = page_sql(page, after_id, per_page)
+    list_query = f"""
+        SELECT c.id, c.name, c.email, c.phone, COUNT(m.id), COALESCE(SUM(m.sale_price), 0)
+        {join}{where} GROUP BY c.id{having} ORDER BY c.id DESC{limit}
+    """
+    list_params = tuple(params + limit_params)
+    
+    # ランク別件数はページに関係なく絞り込み条件全体で集計
+    where, having, params = customer_filter_sql(search, rank_filter)
+    bucket = ' '.join(f"WHEN total_purchase >= %s THEN '{r}'" for r in RANK_ORDER[:-1])
+    counts_query = f"""
+        SELECT CASE {bucket} ELSE 'bronze' END AS rank, COUNT(*) AS cnt
+        FROM (SELECT COALESCE(SUM(m.sale_price), 0) AS total_purchase
+              {join}{where} GROUP BY c.id{having}) t
+        GROUP BY 1
+    """
+    counts_params = tuple(RANK_THRESHOLDS[r] for r in RANK_ORDER[:-1]) + tuple(params)
     
+    with db() as conn:
+        customers = db_fetchall_tuples(conn, list_query, list_params)
+        counts = db_fetchall(conn, counts_query, counts_params)
+    has_next = len(customers) > per_page
+    customers_with_stats = [CustomerRow(*c) for c in customers[:per_page]]
     rank_counts = {'platinum': 0, 'gold': 0, 'silver': 0, 'bronze': 0}
-    for c in customers_with_stats:
-        rank_counts[c['rank']] += 1
-    conn.close()
+    rank_counts.update((r['rank'], r['cnt']) for r in counts)
     
+    total = sum(rank_counts.values())  # 絞り込み後の件数はランク別件数の合計
     return render_template('customers.html', customers=customers_with_stats, rank_filter=rank_filter,
-                          search=search, rank_counts=rank_counts, rank_names=RANK_NAMES,
-                          rank_colors=RANK_COLORS, rank_thresholds=RANK_THRESHOLDS)
+                          search=search, page=page, has_next=has_next, rank_counts=rank_counts, rank_names=RANK_NAMES,
+                          rank_colors=RANK_COLORS, rank_thresholds=RANK_THRESHOLDS,
+                          per_page=per_page, total=total, pages=max(-(-total // per_page), 1))
+
+
+def customer_params(data):
+    """顧客フォームから (name, email, phone, address, memo) を作る"""
+    return (data.get('name'), form_str(data, 'email'), form_str(data, 'phone'),
+            form_str(data, 'address'), form_str(data, 'memo'))
 
 
 @app.route('/customers/add', methods=['GET', 'POST'])
 def add_customer():
     if request.method == 'POST':
-        conn = get_db()
-        db_insert(conn, '''
-            INSERT INTO customers (name, email, phone, address, memo)
-            VALUES (%s, %s, %s, %s, %s)
-        ''', (request.form.get('name'), request.form.get('email') or None,
-              request.form.get('phone') or None, request.form.get('address') or None,
-              request.form.get('memo') or None))
-        conn.close()
+        with write_db() as conn:
+            db_insert(conn, '''
+                INSERT INTO customers (name, email, phone, address, memo)
+                VALUES (%s, %s, %s, %s, %s)
+            ''', customer_params(request.form))
+        cache.delete('api_customers')
         flash('顧客を登録しました', 'success')
         return redirect(url_for('customers_list'))
     return render_template('customer_form.html', customer=None, action='add')
@@ -471,20 +1164,18 @@ def add_customer():
 
 @app.route('/customers/edit/<int:id>', methods=['GET', 'POST'])
 def edit_customer(id):
-    conn = get_db()
     if request.method == 'POST':
-        db_execute(conn, '''
-            UPDATE customers SET name=%s, email=%s, phone=%s, address=%s, memo=%s,
-                updated_at=CURRENT_TIMESTAMP WHERE id=%s
-        ''', (request.form.get('name'), request.form.get('email') or None,
-              request.form.get('phone') or None, request.form.get('address') or None,
-              request.form.get('memo') or None, id))
-        conn.close()
+        with write_db() as conn:
+            db_execute(conn, '''
+                UPDATE customers SET name=%s, email=%s, phone=%s, address=%s, memo=%s,
+                    updated_at=CURRENT_TIMESTAMP WHERE id=%s
+            ''', customer_params(request.form) + (id,))
+        cache.delete('api_customers')
         flash('顧客情報を更新しました', 'success')
         return redirect(url_for('customers_list'))
     
-    customer = db_fetchone(conn, 'SELECT * FROM customers WHERE id = %s', (id,))
-    conn.close()
+    with db() as conn:
+        customer = db_fetchone(conn, CUSTOMER_BY_ID_SQL, (id,))
     if not customer:
         flash('顧客が見つかりません', 'error')
         return redirect(url_for('customers_list'))
@@ -493,19 +1184,14 @@ def edit_customer(id):
 
 @app.route('/customers/view/<int:id>')
 def view_customer(id):
-    conn = get_db()
-    customer = db_fetchone(conn, 'SELECT * FROM customers WHERE id = %s', (id,))
+    with db() as conn:
+        customer = db_fetchone(conn, CUSTOMER_BY_ID_SQL, (id,))
+        if customer:
+            purchases, stats = get_customer_purchases(conn, id)
     if not customer:
-        conn.close()
         flash('顧客が見つかりません', 'error')
         return redirect(url_for('customers_list'))
     
-    purchases = db_fetchall(conn, '''
-        SELECT * FROM merchandise WHERE customer_id = %s AND sold_date IS NOT NULL AND sold_date != ''
-        ORDER BY sold_date DESC
-    ''', (id,))
-    stats = get_customer_stats(conn, id)
-    
     next_rank_info = None
     if stats['rank'] == 'bronze':
         next_rank_info = {'rank': 'シルバー', 'needed': RANK_THRESHOLDS['silver'] - stats['total_purchase']}
@@ -513,29 +1199,34 @@ def view_customer(id):
         next_rank_info = {'rank': 'ゴールド', 'needed': RANK_THRESHOLDS['gold'] - stats['total_purchase']}
     elif stats['rank'] == 'gold':
         next_rank_info = {'rank': 'プラチナ', 'needed': RANK_THRESHOLDS['platinum'] - stats['total_purchase']}
-    conn.close()
     
     return render_template('customer_view.html', customer=customer, purchases=purchases,
-                          stats=stats, next_rank_info=next_rank_info, rank_thresholds=RANK_THRESHOLDS,
-                          calculate_profit=calculate_profit)
+                          stats=stats, next_rank_info=next_rank_info, rank_thresholds=RANK_THRESHOLDS)
 
 
 @app.route('/customers/delete/<int:id>', methods=['POST'])
 def delete_customer(id):
-    conn = get_db()
-    db_execute(conn, 'UPDATE merchandise SET customer_id = NULL WHERE customer_id = %s', (id,))
-    db_execute(conn, 'DELETE FROM customers WHERE id = %s', (id,))
-    conn.close()
+    with write_db() as conn:
+        # 購入履歴の customer_id は外部キー (ON DELETE SET NULL) でDBが外す
+        db_execute(conn, 'DELETE FROM customers WHERE id = %s', (id,))
+    cache.delete('api_customers')
     flash('顧客を削除しました', 'success')
     return redirect(url_for('customers_list'))
 
 
 @app.route('/api/customers')
 def api_customers():
-    conn = get_db()
-    customers = db_fetchall(conn, 'SELECT id, name FROM customers ORDER BY name')
-    conn.close()
-    return jsonify([{'id': c['id'], 'name': c['name']} for c in customers])
+    # JSON本文はプロセス内にキャッシュし、304判定はリクエストごとに行う
+    body = cache.get('api_customers')
+    if body is None:
+        with db() as conn:
+            customers = db_fetchall_tuples(conn, 'SELECT id, name FROM customers ORDER BY name')
+        body = json_bytes([{'id': id, 'name': name} for id, name in customers])
+        cache.set('api_customers', body)
+    response = app.response_class(body, mimetype='application/json')
+    response.add_etag()
+    response.cache_control.max_age = API_MAX_AGE
+    return response.make_conditional(request)
 
 
 if __name__ == '__main__':